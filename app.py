@@ -1,16 +1,33 @@
 # app.py
 import os
+import re
 import json
 import time
-from datetime import datetime
+import zlib
+import logging
+import queue
+import atexit
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache
 from flask import Flask, request
+import orjson
 import requests
-import gspread
-from google.oauth2.service_account import Credentials
-from gspread.exceptions import WorksheetNotFound
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 app = Flask(__name__)
-app.logger.setLevel("INFO")
+# INFO by default; set LOG_LEVEL=WARNING in production to keep per-completion logs off the hot path
+_log_level = (os.getenv("LOG_LEVEL") or "").strip().upper() or "INFO"
+if isinstance(logging.getLevelName(_log_level), int):
+    app.logger.setLevel(_log_level)
+else:
+    app.logger.setLevel("INFO")
+    app.logger.warning("Unknown LOG_LEVEL %r, using INFO", _log_level)
+# Meta webhook payloads are a few KB; reject anything unreasonable before reading it
+app.config["MAX_CONTENT_LENGTH"] = 1 << 20
 
 # ---------------- Config ----------------
 GOOGLE_CREDS_ENV = os.getenv("GOOGLE_SHEETS_CREDENTIALS", "").strip()
@@ -27,15 +44,59 @@ SUPABASE_API_KEY = os.getenv("SUPABASE_API_KEY", "").strip()
 # New: comma-separated CC emails for Supabase function to use (optional)
 CC_EMAILS = os.getenv("CC_EMAILS", "").strip()
 
+# Optional: share sessions/dedup across gunicorn workers and instances via Redis
+REDIS_URL = os.getenv("REDIS_URL", "").strip()
+
+WHATSAPP_CONFIGURED = bool(WHATSAPP_TOKEN and PHONE_NUMBER_ID)
+# report missing config once at startup rather than on every message
+if not WHATSAPP_CONFIGURED:
+    app.logger.warning("WHATSAPP_TOKEN/PHONE_NUMBER_ID not set - replies will not be sent.")
+if not SUPABASE_FUNCTION_URL:
+    app.logger.warning("SUPABASE_FUNCTION_URL not set - valuation emails will not be sent.")
+
 WHATSAPP_API_URL = f"https://graph.facebook.com/v17.0/{PHONE_NUMBER_ID}/messages"
 WHATSAPP_HEADERS = {"Authorization": f"Bearer {WHATSAPP_TOKEN}", "Content-Type": "application/json"}
 
+SUPABASE_HEADERS = {"Content-Type": "application/json"}
+if SUPABASE_API_KEY:
+    SUPABASE_HEADERS["Authorization"] = f"Bearer {SUPABASE_API_KEY}"
+
+# Shared keep-alive sessions so outbound calls reuse TLS connections; one per host
+# so each only ever carries its own Authorization header. Every call is a POST,
+# which urllib3 only retries when the connection couldn't be made: an HTTP error
+# response is not retried, so a message or email is never sent twice.
+def _pooled_session(headers):
+    session = requests.Session()
+    session.headers.update(headers)
+    adapter = HTTPAdapter(
+        pool_connections=16, pool_maxsize=64,
+        max_retries=Retry(total=2, backoff_factor=0.2),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+WA_SESSION = _pooled_session(WHATSAPP_HEADERS)
+SUPABASE_SESSION = _pooled_session(SUPABASE_HEADERS)
+
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
 
+_redis = None
+if REDIS_URL:
+    import redis
+    # one bounded pool shared by all webhook/email worker threads
+    _redis = redis.Redis(connection_pool=redis.ConnectionPool.from_url(
+        REDIS_URL, max_connections=64, decode_responses=True))
+
 # ---------------- Google Sheets init ----------------
 _gs_client = None
 _worksheet = None
 _gs_init_error = None
+# failed inits are retried with exponential backoff instead of on every write
+GS_RETRY_MIN_SECONDS = 30
+GS_RETRY_MAX_SECONDS = 10 * 60
+_gs_next_attempt = 0.0
+_gs_retry_delay = GS_RETRY_MIN_SECONDS
 
 # desired sheet headers: Name added, Valuation will be numeric midpoint
 SHEET_HEADERS = [
@@ -44,6 +105,12 @@ SHEET_HEADERS = [
     "Revenue Type", "Email", "Valuation"
 ]
 
+# with Redis, a verified header row is remembered across workers and restarts so each
+# worker boot doesn't spend a Sheets read on it; the key changes with the header list
+SHEET_HEADERS_OK_TTL_SECONDS = 24 * 60 * 60
+
+_SHEET_HEADERS_OK_KEY = f"sheet_headers_ok:{SHEET_ID}:{SHEET_NAME}:{zlib.crc32('|'.join(SHEET_HEADERS).encode()):08x}"
+
 def _load_service_account_info():
     raw = GOOGLE_CREDS_ENV
     if raw:
@@ -59,109 +126,213 @@ def _load_service_account_info():
             return json.load(f)
     raise Exception("No valid Google service account credentials found. Set GOOGLE_SHEETS_CREDENTIALS or upload service_account.json")
 
+# parsed once at startup; the credentials don't change without a restart
+try:
+    _CREDS_INFO = _load_service_account_info()
+    _CREDS_ERROR = None
+except Exception as e:
+    _CREDS_INFO = None
+    _CREDS_ERROR = str(e)
+
+def _gs_init_failed(message):
+    global _gs_init_error, _gs_retry_delay, _gs_next_attempt
+    _gs_init_error = message
+    _gs_next_attempt = time.time() + _gs_retry_delay
+    app.logger.error("%s (retrying in %ss)", message, _gs_retry_delay)
+    _gs_retry_delay = min(_gs_retry_delay * 2, GS_RETRY_MAX_SECONDS)
+    return None
+
+_gs_lock = threading.Lock()
+
+def _gs_retry_wait():
+    """Seconds until a failed Sheets init may be retried (0 if it may be tried now)."""
+    if _worksheet is not None or not _gs_init_error:
+        return 0.0
+    return max(0.0, _gs_next_attempt - time.time())
+
 def try_init_gs():
-    global _gs_client, _worksheet, _gs_init_error
     if _worksheet is not None:
         return _worksheet
+    with _gs_lock:
+        return _init_gs()
+
+def _init_gs():
+    global _gs_client, _worksheet, _gs_init_error, _gs_retry_delay
+    if _worksheet is not None:
+        return _worksheet
+    now = time.time()
+    if _gs_init_error and now < _gs_next_attempt:
+        return None
+    if _CREDS_INFO is None:
+        return _gs_init_failed(f"Google Sheets auth failed: {_CREDS_ERROR}")
     try:
-        info = _load_service_account_info()
-        creds = Credentials.from_service_account_info(info, scopes=SCOPES)
+        # imported lazily: google-auth/gspread are heavy and only needed once a row is written
+        import gspread
+        from google.oauth2.service_account import Credentials
+        from gspread.exceptions import WorksheetNotFound
+        creds = Credentials.from_service_account_info(_CREDS_INFO, scopes=SCOPES)
         _gs_client = gspread.authorize(creds)
         if not SHEET_ID:
-            _gs_init_error = "SHEET_ID not configured"
-            app.logger.error(_gs_init_error)
-            return None
+            return _gs_init_failed("SHEET_ID not configured")
         spreadsheet = _gs_client.open_by_key(SHEET_ID)
+        created = False
         try:
             _worksheet = spreadsheet.worksheet(SHEET_NAME)
         except WorksheetNotFound:
             _worksheet = spreadsheet.add_worksheet(title=SHEET_NAME, rows="2000", cols="20")
-            _worksheet.insert_row(SHEET_HEADERS, index=1)
-        # ensure header row contains all required columns (if sheet existed but different headers)
+            created = True
+        # ensure header row contains all required columns (new sheet, or existing one with different headers)
         try:
-            existing = _worksheet.row_values(1)
-            if len(existing) < len(SHEET_HEADERS) or existing[:len(SHEET_HEADERS)] != SHEET_HEADERS:
-                # update header row to canonical headers (keeps data below)
-                _worksheet.delete_row(1)
-                _worksheet.insert_row(SHEET_HEADERS, index=1)
+            if created or _redis is None or not _redis.exists(_SHEET_HEADERS_OK_KEY):
+                # a sheet we just created is empty: write the header without reading row 1 first
+                existing = [] if created else _worksheet.row_values(1)
+                if len(existing) < len(SHEET_HEADERS) or existing[:len(SHEET_HEADERS)] != SHEET_HEADERS:
+                    # overwrite row 1 in place: one call, and rows below don't shift
+                    _worksheet.update(range_name="A1", values=[SHEET_HEADERS])
+                if _redis is not None:
+                    _redis.set(_SHEET_HEADERS_OK_KEY, "1", ex=SHEET_HEADERS_OK_TTL_SECONDS)
         except Exception:
             pass
         app.logger.info("Google Sheets initialized: %s", SHEET_NAME)
         _gs_init_error = None
+        _gs_retry_delay = GS_RETRY_MIN_SECONDS
         return _worksheet
     except Exception as e:
-        _gs_init_error = f"Google Sheets auth failed: {e}"
-        app.logger.error(_gs_init_error)
-        return None
+        return _gs_init_failed(f"Google Sheets auth failed: {e}")
 
 # ---------------- WhatsApp helpers ----------------
+def _text_body(to, text):
+    # only "to" and the body vary, so splice them into the fixed envelope
+    return (b'{"messaging_product":"whatsapp","to":' + orjson.dumps(to)
+            + b',"type":"text","text":{"body":' + orjson.dumps(text) + b'}}')
+
+@lru_cache(maxsize=64)
+def _interactive_tail(text, buttons):
+    # prompts and button sets are fixed strings, so each serialized tail is built once
+    interactive = {
+        "type":"button",
+        "body":{"text":text},
+        "action":{"buttons":[{"type":"reply","reply":{"id":b.lower().replace(" ","_"),"title":b}} for b in buttons]}
+    }
+    return b',"type":"interactive","interactive":' + orjson.dumps(interactive) + b'}'
+
+def _buttons_body(to, text, buttons):
+    return b'{"messaging_product":"whatsapp","to":' + orjson.dumps(to) + _interactive_tail(text, buttons)
+
 def send_whatsapp_text(to, text):
-    if not WHATSAPP_TOKEN or not PHONE_NUMBER_ID:
+    if not WHATSAPP_CONFIGURED:
         app.logger.debug("WhatsApp not configured - skipping send.")
         return
-    payload = {"messaging_product":"whatsapp","to":to,"type":"text","text":{"body":text}}
     try:
-        r = requests.post(WHATSAPP_API_URL, headers=WHATSAPP_HEADERS, json=payload, timeout=8)
+        r = WA_SESSION.post(WHATSAPP_API_URL, data=_text_body(to, text), timeout=10)
         app.logger.debug("WA text sent status %s", r.status_code)
     except Exception as e:
         app.logger.error("WA send failed: %s", e)
 
 def send_whatsapp_buttons(to, text, buttons):
-    if not WHATSAPP_TOKEN or not PHONE_NUMBER_ID:
+    if not WHATSAPP_CONFIGURED:
         app.logger.debug("WhatsApp not configured - skipping buttons.")
         return
-    payload = {
-        "messaging_product":"whatsapp",
-        "to":to,
-        "type":"interactive",
-        "interactive":{
-            "type":"button",
-            "body":{"text":text},
-            "action":{"buttons":[{"type":"reply","reply":{"id":b.lower().replace(" ","_"),"title":b}} for b in buttons]}
-        }
-    }
     try:
-        r = requests.post(WHATSAPP_API_URL, headers=WHATSAPP_HEADERS, json=payload, timeout=8)
+        r = WA_SESSION.post(WHATSAPP_API_URL, data=_buttons_body(to, text, tuple(buttons)), timeout=10)
         app.logger.debug("WA buttons status %s", r.status_code)
     except Exception as e:
         app.logger.error("WA send failed: %s", e)
 
 # ---------------- Validation & parsing ----------------
+_EMAIL_RE = re.compile(r"[^@]+@[^@]+\.[^@]+")
+_MULTI_SPLIT_RE = re.compile(r"[,;]")
+_NUM_STRIP_RE = re.compile(r"[^\d.\-]")
+
+_STORE_URL_PREFIXES = {
+    "app_store": ("https://apps.apple.com/", "http://apps.apple.com/"),
+    "play_store": ("https://play.google.com/", "http://play.google.com/",
+                   "https://market.android.com/", "http://market.android.com/"),
+}
+
 def is_valid_url(u, store):
     if not u: return False
     u = u.strip()
-    if not (u.startswith("http://") or u.startswith("https://")):
-        return False
-    if store == "app_store":
-        return "apps.apple.com" in u
-    if store == "play_store":
-        return "play.google.com" in u or "market.android.com" in u
-    return True
+    prefixes = _STORE_URL_PREFIXES.get(store)
+    if prefixes is not None:
+        return u.startswith(prefixes)
+    return u.startswith(("http://", "https://"))
+
+# the characters parse_number keeps (plus a sign); no exponent, since it would strip the "e"
+_NUMBER_CHARS = frozenset("0123456789.+-")
 
+@lru_cache(maxsize=4096)
 def is_number(s):
+    t = s.replace(",","").strip()
+    if not t:
+        return False
+    # fast path for plain digits so typical answers never hit the exception machinery
+    u = t[1:] if t[0] in "+-" else t
+    if u.replace(".", "", 1).isdecimal():
+        return True
+    # words ("hello", but also "nan"/"inf"/"1e6") are rejected without trying float()
+    if not _NUMBER_CHARS.issuperset(t):
+        return False
     try:
-        float(str(s).replace(",","").strip())
+        float(t)
         return True
-    except:
+    except ValueError:
         return False
 
+@lru_cache(maxsize=4096)
 def parse_number(s):
     """Return numeric float or None. Strips commas, currency, spaces."""
     try:
         if s is None:
             return None
-        cleaned = str(s).strip()
-        cleaned = cleaned.replace(",", "")
-        cleaned = "".join(ch for ch in cleaned if (ch.isdigit() or ch in ".-"))
+        cleaned = _NUM_STRIP_RE.sub("", s)
         if cleaned == "" or cleaned == "-" or cleaned == ".":
             return None
         return float(cleaned)
-    except:
+    except ValueError:
         return None
 
+FINANCIAL_KEYS = ("annual_revenue", "marketing_cost", "team_cost", "server_cost", "annual_profit")
+
+def parse_financials(answers):
+    """Parse the numeric answers once; unparseable or missing values are None."""
+    return {k: parse_number(answers.get(k)) for k in FINANCIAL_KEYS}
+
 def is_valid_email(e):
     if not e: return False
-    return "@" in e and "." in e
+    return _EMAIL_RE.match(e) is not None
+
+# CC_EMAILS is fixed for the process: parse it once, keeping valid addresses in order, deduped
+CC_LIST = list(dict.fromkeys(e for e in (x.strip() for x in CC_EMAILS.split(",")) if is_valid_email(e)))
+CC_HEADER = ", ".join(CC_LIST)
+
+# exact answers (button ids, menu numbers, names) -> normalized revenue type
+_REVENUE_CHOICES = {
+    "1": "iap", "iap": "iap", "in-app": "iap", "in app": "iap",
+    "2": "subscription", "subscription": "subscription", "sub": "subscription",
+    "3": "ad", "ad": "ad", "ads": "ad",
+}
+
+def parse_multi_choice(raw):
+    """Map a free-form revenue type answer (e.g. "Ad,IAP" or "1,3") to a de-duplicated list."""
+    norm = []
+    for p in _MULTI_SPLIT_RE.split(raw.lower()):
+        p = p.strip()
+        if not p:
+            continue
+        label = _REVENUE_CHOICES.get(p)
+        if label is None:
+            # loose match for things like "ads revenue" or "subscriptions"
+            if "ad" in p:
+                label = "ad"
+            elif "sub" in p:
+                label = "subscription"
+            elif "iap" in p:
+                label = "iap"
+            else:
+                continue
+        norm.append(label)
+    return list(dict.fromkeys(norm))
 
 def normalize_revenue_type(raw: str):
     if not raw: return ""
@@ -174,32 +345,133 @@ def normalize_revenue_type(raw: str):
         return "iap"
     return s
 
+RT_IAP, RT_SUBSCRIPTION, RT_AD = 1, 2, 4
+_REVENUE_TYPE_BITS = {"iap": RT_IAP, "subscription": RT_SUBSCRIPTION, "ad": RT_AD}
+
+def primary_revenue_type(answers):
+    """Pick the revenue type that drives the valuation (ad > subscription > iap)."""
+    mask = 0
+    for label in answers.get("revenue_type_normalized", "").split(", "):
+        mask |= _REVENUE_TYPE_BITS.get(label, 0)
+    if mask & RT_AD:
+        return "ad"
+    if mask & RT_SUBSCRIPTION:
+        return "subscription"
+    if mask & RT_IAP:
+        return "iap"
+    # nothing recognised: fall back to the free-text answer
+    return normalize_revenue_type(answers.get("revenue_type_raw") or "")
+
 # ---------------- Valuation compute ----------------
+# normalized revenue type -> (min, max) profit multiple
+VALUATION_MULTIPLES = {
+    "ad": (1.0, 1.7),
+    "subscription": (1.5, 2.3),
+    "iap": (1.5, 2.0),
+}
+DEFAULT_VALUATION_MULTIPLE = (2.5, 2.5)
+
 def compute_valuation(profit_val, revenue_type_text):
     try:
         profit = float(profit_val) if profit_val not in (None,"") else 0.0
-    except:
+    except (TypeError, ValueError):
         profit = 0.0
-    rt = (revenue_type_text or "").lower()
     if profit <= 0 or profit < 1000:
         return 1000.0, 1000.0, 1000.0
-    if "ad" in rt:
-        vmin = profit * 1.0; vmax = profit * 1.7
-    elif "subscription" in rt or "sub" in rt:
-        vmin = profit * 1.5; vmax = profit * 2.3
-    elif "iap" in rt:
-        vmin = profit * 1.5; vmax = profit * 2.0
-    else:
-        vmin = profit * 2.5; vmax = profit * 2.5
+    rt = (revenue_type_text or "").strip().lower()
+    # callers pass an already normalized type; anything else goes through normalize_revenue_type
+    lo, hi = VALUATION_MULTIPLES.get(rt) or VALUATION_MULTIPLES.get(normalize_revenue_type(rt), DEFAULT_VALUATION_MULTIPLE)
+    vmin = profit * lo; vmax = profit * hi
     return vmin, vmax, (vmin + vmax) / 2.0
 
 # ---------------- Save to sheet ----------------
-def save_to_sheet(user_id, answers, valuation_mid):
+# Completed rows are queued and appended in batches by a background thread so the
+# webhook never waits on the Sheets API.
+SHEET_FLUSH_INTERVAL_SECONDS = 2.0
+SHEET_BATCH_MAX_ROWS = 500
+# a failed write keeps its rows and is retried with exponential backoff
+SHEET_RETRY_MIN_SECONDS = 5
+SHEET_RETRY_MAX_SECONDS = 5 * 60
+# bound memory if Sheets stays unreachable for a long time
+SHEET_QUEUE_MAX_ROWS = 10000
+
+_sheet_queue = queue.Queue(maxsize=SHEET_QUEUE_MAX_ROWS)
+_sheet_stop = threading.Event()
+_sheet_worker = None
+_sheet_worker_lock = threading.Lock()
+
+def _drain_sheet_queue(rows, limit):
+    while len(rows) < limit:
+        try:
+            rows.append(_sheet_queue.get_nowait())
+        except queue.Empty:
+            break
+    return rows
+
+def _append_rows_to_sheet(rows):
     ws = try_init_gs()
     if ws is None:
-        app.logger.warning("Skipping sheet save: %s", _gs_init_error)
+        app.logger.warning("Sheets unavailable, holding %d row(s): %s", len(rows), _gs_init_error)
         return False
-    now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    try:
+        ws.append_rows(rows, value_input_option="RAW")
+        app.logger.info("Saved %d row(s) to Google Sheet", len(rows))
+        return True
+    except Exception as e:
+        app.logger.error("Failed to append rows: %s", e)
+        return False
+
+def _sheet_writer():
+    # rows stay in `pending` until a write succeeds; new completions wait in the queue
+    pending = []
+    retry_delay = SHEET_RETRY_MIN_SECONDS
+    while not _sheet_stop.is_set():
+        if not pending:
+            try:
+                pending.append(_sheet_queue.get(timeout=1.0))
+            except queue.Empty:
+                continue
+            # short debounce so completions arriving close together share one API call
+            _sheet_stop.wait(SHEET_FLUSH_INTERVAL_SECONDS)
+        _drain_sheet_queue(pending, SHEET_BATCH_MAX_ROWS)
+        if _append_rows_to_sheet(pending):
+            pending = []
+            retry_delay = SHEET_RETRY_MIN_SECONDS
+            continue
+        # while Sheets init is backing off, wait out its window instead of polling it
+        wait = max(retry_delay, _gs_retry_wait())
+        app.logger.warning("Keeping %d row(s) for retry in %.0fs", len(pending), wait)
+        _sheet_stop.wait(wait)
+        retry_delay = min(retry_delay * 2, SHEET_RETRY_MAX_SECONDS)
+    # shutting down: flush whatever is still pending or queued
+    while True:
+        _drain_sheet_queue(pending, SHEET_BATCH_MAX_ROWS)
+        if not pending:
+            break
+        if not _append_rows_to_sheet(pending):
+            # last chance: log the rows in full so they can be re-entered by hand
+            for row in _drain_sheet_queue(pending, SHEET_QUEUE_MAX_ROWS + SHEET_BATCH_MAX_ROWS):
+                app.logger.error("Sheet unavailable at shutdown, dropping row: %s", row)
+            break
+        pending = []
+
+def _ensure_sheet_worker():
+    global _sheet_worker
+    if _sheet_worker is not None:
+        return
+    with _sheet_worker_lock:
+        if _sheet_worker is None:
+            _sheet_worker = threading.Thread(target=_sheet_writer, name="sheet-writer", daemon=True)
+            _sheet_worker.start()
+
+@atexit.register
+def _flush_sheet_on_exit():
+    _sheet_stop.set()
+    if _sheet_worker is not None:
+        _sheet_worker.join(timeout=15)
+
+def save_to_sheet(user_id, answers, valuation_mid):
+    now = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
     app_store_link = answers.get("app_store_link","")
     play_store_link = answers.get("play_store_link","")
     row = [
@@ -218,19 +490,20 @@ def save_to_sheet(user_id, answers, valuation_mid):
         answers.get("email",""),
         valuation_mid  # numeric midpoint
     ]
+    _ensure_sheet_worker()
     try:
-        ws.append_row(row)
-        app.logger.info("Saved row to Google Sheet for user %s", user_id)
-        return True
-    except Exception as e:
-        app.logger.error("Failed to append row: %s", e)
+        _sheet_queue.put_nowait(row)
+    except queue.Full:
+        app.logger.error("Sheet queue full, dropping row for user %s: %s", user_id, row)
         return False
+    app.logger.debug("Queued sheet row for user %s", user_id)
+    return True
 
 # ---------------- Call Supabase function (existing) ----------------
-def call_supabase_send_email_for_existing_function(answers, valuation_text, valuation_mid):
+def call_supabase_send_email_for_existing_function(answers, figures, normalized_rt, valuation_text, valuation_mid):
     url = SUPABASE_FUNCTION_URL
     if not url:
-        app.logger.warning("No SUPABASE_FUNCTION_URL configured.")
+        app.logger.debug("No SUPABASE_FUNCTION_URL configured.")
         return False, "No function URL"
 
     # pick a single appLink per function expectation
@@ -240,19 +513,11 @@ def call_supabase_send_email_for_existing_function(answers, valuation_text, valu
     elif answers.get("app_store_link"):
         app_link = answers.get("app_store_link")
 
-    revenue_val = parse_number(answers.get("annual_revenue", None))
-    marketing_val = parse_number(answers.get("marketing_cost", None))
-    team_val = parse_number(answers.get("team_cost", None))
-    server_val = parse_number(answers.get("server_cost", None))
-    profit_val = parse_number(answers.get("annual_profit", None))
-    if profit_val is None:
-        raw = str(answers.get("annual_profit","")).replace(",","").strip()
-        try:
-            profit_val = float(raw) if raw not in ("", None) else 0.0
-        except:
-            profit_val = 0.0
-
-    normalized_rt = normalize_revenue_type(answers.get("revenue_type_normalized") or answers.get("revenue_type_raw") or answers.get("revenue_type",""))
+    revenue_val = figures["annual_revenue"]
+    marketing_val = figures["marketing_cost"]
+    team_val = figures["team_cost"]
+    server_val = figures["server_cost"]
+    profit_val = figures["annual_profit"] or 0.0
 
     # build function payload using exactly the keys their function expects
     payload = {
@@ -263,7 +528,7 @@ def call_supabase_send_email_for_existing_function(answers, valuation_text, valu
         "marketingCost": marketing_val if marketing_val is not None else "",
         "teamCost": team_val if team_val is not None else "",
         "serverCost": server_val if server_val is not None else "",
-        "profit": profit_val if profit_val is not None else 0,
+        "profit": profit_val,
         "email": answers.get("email",""),
         "phone": "",  # we don't collect phone
         # extra helpful fields (function will ignore unknown keys)
@@ -275,272 +540,494 @@ def call_supabase_send_email_for_existing_function(answers, valuation_text, valu
     }
 
     # Add CCs if configured
-    cc_list = []
-    if CC_EMAILS:
-        # parse comma-separated env var
-        cc_list = [e.strip() for e in CC_EMAILS.split(",") if e.strip()]
-        if cc_list:
-            payload["cc_emails"] = cc_list
-            payload["cc"] = ", ".join(cc_list)
-
-    headers = {"Content-Type":"application/json"}
-    if SUPABASE_API_KEY:
-        headers["Authorization"] = f"Bearer {SUPABASE_API_KEY}"
-
-    app.logger.info("Calling Supabase function with payload summary: name=%s email=%s profit=%s rt=%s valuation_mid=%s cc=%s",
+    if CC_LIST:
+        payload["cc_emails"] = CC_LIST
+        payload["cc"] = CC_HEADER
+
+    app.logger.debug("Calling Supabase function with payload summary: name=%s email=%s profit=%s rt=%s valuation_mid=%s cc=%s",
                     payload["name"], payload["email"], payload["profit"], payload["revenueType"], payload["_valuation_mid"], payload.get("cc",""))
     try:
-        r = requests.post(url, json=payload, headers=headers, timeout=15)
+        r = SUPABASE_SESSION.post(url, data=orjson.dumps(payload), timeout=15)
         app.logger.info("Supabase function returned status=%s text=%s", r.status_code, (r.text[:300] + "...") if r.text and len(r.text)>300 else r.text)
         return (r.status_code in (200,201,202)), r.text
     except Exception as e:
         app.logger.exception("Failed calling Supabase function: %s", e)
         return False, str(e)
 
+WEBHOOK_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="webhook")
+
+def _log_worker_error(future):
+    exc = future.exception()
+    if exc is not None:
+        app.logger.error("Background task failed: %s", exc, exc_info=exc)
+
+# Email delivery (via the Supabase function) runs on a small pool so the webhook can
+# reply right away; the user only hears back again if sending failed.
+EMAIL_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="email")
+
+def send_valuation_email(user_id, answers, figures, normalized_rt, valuation_text, valuation_mid):
+    try:
+        ok, resp = call_supabase_send_email_for_existing_function(answers, figures, normalized_rt, valuation_text, valuation_mid)
+    except Exception as e:
+        ok, resp = False, str(e)
+    if not ok:
+        app.logger.warning("Supabase function failed: %s", resp)
+        send_whatsapp_text(user_id, EMAIL_FAILED_TEXT)
+    return ok
+
 # ---------------- Conversation flow ----------------
-user_states = {}
-processed_msg_ids = set()
+@dataclass(slots=True)
+class UserState:
+    step: int = -1
+    answers: dict = field(default_factory=dict)
+    questions: tuple = ()
+    started_at: float = field(default_factory=time.time)
+    last_active: float = field(default_factory=time.time)
+
+user_states = OrderedDict()
+processed_msg_ids = OrderedDict()
+MAX_PROCESSED_IDS = 5000
 SESSION_TIMEOUT_SECONDS = 15 * 60
 
-OTHER_QUESTIONS = [
-    {"key":"annual_revenue","text":"What is your annual revenue (USD)? (numbers only, e.g. 250000)","type":"number"},
-    {"key":"marketing_cost","text":"What is your annual marketing cost (USD)?","type":"number"},
-    {"key":"team_cost","text":"What is your annual team cost (USD)?","type":"number"},
-    {"key":"server_cost","text":"What is your annual server cost (USD)?","type":"number"},
-    {"key":"annual_profit","text":"What is your annual profit (USD)? (numbers only)","type":"number"},
-    {"key":"revenue_type","text":"Which revenue types apply? Reply with one or more: Ad, Subscription, IAP (you can type Ad or 3 or Ad,IAP)","type":"revenue"},
-    {"key":"email","text":"Please share your email address (we will send valuation there)","type":"email"},
-]
+# users who just finished are ignored for a while so stray follow-ups ("thanks")
+# don't restart the flow; bounded LRU of user_id -> completion time
+COMPLETION_COOLDOWN_SECONDS = 5 * 60
+MAX_COOLDOWN_ENTRIES = 10000
+_completed_cooldown = OrderedDict()
+_cooldown_lock = threading.Lock()
 
-@app.route("/webhook", methods=["GET","POST"])
-def webhook():
-    if request.method == "GET":
-        token = request.args.get("hub.verify_token")
-        if token and token == VERIFY_TOKEN:
-            return request.args.get("hub.challenge"), 200
-        return "Invalid verify token", 403
+# <-- UPDATED GREETING MESSAGE START -->
+GREETING_TEXT = (
+    "Hi 👋 I’m Orion from Kalagato.\n"
+    "We’re interested in acquiring quality apps like yours.\n"
+    "Would you be open to selling your app if the valuation looks right?"
+)
+# <-- UPDATED GREETING MESSAGE END -->
+THANK_YOU_TEMPLATE = "✅ Thank you {name}.We've sent your valuation to your email. The final valuation may vary slightly based on the data during processing"
+EMAIL_FAILED_TEXT = "⚠️ We saved your data, but couldn't send the email automatically. Please visit www.kalagato.ai to get valuation."
 
-    data = request.get_json(silent=True)
-    if not data:
-        return "No payload", 400
+Question = namedtuple("Question", "key text type")
+
+APP_STORE_LINK_QUESTION = Question("app_store_link", "Please provide the App Store link (https://...)", "link_appstore")
+PLAY_STORE_LINK_QUESTION = Question("play_store_link", "Please provide the Play Store link (https://...)", "link_playstore")
+
+OTHER_QUESTIONS = (
+    Question("annual_revenue", "What is your annual revenue (USD)? (numbers only, e.g. 250000)", "number"),
+    Question("marketing_cost", "What is your annual marketing cost (USD)?", "number"),
+    Question("team_cost", "What is your annual team cost (USD)?", "number"),
+    Question("server_cost", "What is your annual server cost (USD)?", "number"),
+    Question("annual_profit", "What is your annual profit (USD)? (numbers only)", "number"),
+    Question("revenue_type", "Which revenue types apply? Reply with one or more: Ad, Subscription, IAP (you can type Ad or 3 or Ad,IAP)", "revenue"),
+    Question("email", "Please share your email address (we will send valuation there)", "email"),
+)
+
+# full question sequence per listing, built once and shared by every session
+QUESTIONS_BY_LISTING = {
+    "app_store": (APP_STORE_LINK_QUESTION,) + OTHER_QUESTIONS,
+    "play_store": (PLAY_STORE_LINK_QUESTION,) + OTHER_QUESTIONS,
+    "both": (APP_STORE_LINK_QUESTION, PLAY_STORE_LINK_QUESTION) + OTHER_QUESTIONS,
+}
+
+# ---------------- Session store ----------------
+# Sessions, dedup and cooldown live in this process by default. With REDIS_URL set
+# they move to Redis (TTL keys), so any gunicorn worker or instance can serve any
+# message. Questions aren't stored: they are rebuilt from the saved listing.
+SESSION_STATE_TTL_SECONDS = 2 * SESSION_TIMEOUT_SECONDS
+DEDUP_TTL_SECONDS = 60 * 60
+# in-process sessions are kept in save order (oldest first), so abandoned ones are
+# trimmed from the front on each save: past the TTL, or beyond the cap
+MAX_USER_STATES = 10000
+_states_lock = threading.Lock()
+
+def _session_key(user_id):
+    return f"sess:{user_id}"
 
-    for entry in data.get("entry", []):
-        for change in entry.get("changes", []):
-            value = change.get("value", {})
-            messages = value.get("messages", [])
+def load_state(user_id):
+    if _redis is None:
+        return user_states.get(user_id)
+    raw = _redis.get(_session_key(user_id))
+    if raw is None:
+        return None
+    d = orjson.loads(raw)
+    return UserState(
+        step=d["step"],
+        answers=d["answers"],
+        questions=QUESTIONS_BY_LISTING.get(d["answers"].get("listing"), ()),
+        started_at=d["started_at"],
+        last_active=d["last_active"],
+    )
+
+def save_state(user_id, state):
+    if _redis is None:
+        with _states_lock:
+            user_states[user_id] = state
+            user_states.move_to_end(user_id)
+            cutoff = time.time() - SESSION_STATE_TTL_SECONDS
+            while user_states and (len(user_states) > MAX_USER_STATES or next(iter(user_states.values())).last_active < cutoff):
+                user_states.popitem(last=False)
+        return
+    raw = orjson.dumps({"step": state.step, "answers": state.answers,
+                        "started_at": state.started_at, "last_active": state.last_active})
+    _redis.set(_session_key(user_id), raw, ex=SESSION_STATE_TTL_SECONDS)
+
+def drop_state(user_id):
+    if _redis is None:
+        with _states_lock:
+            user_states.pop(user_id, None)
+        return
+    _redis.delete(_session_key(user_id))
+
+# Webhook payloads are processed concurrently on WEBHOOK_POOL: messages from the
+# same user are serialized through a sharded lock (a Redis lock when Redis is
+# configured, so it also holds across processes), and the dedup LRU has its own.
+_USER_LOCKS = [threading.Lock() for _ in range(64)]
+_dedup_lock = threading.Lock()
+
+# A handler sends at most two WhatsApp messages, each up to 3 attempts (2 connection
+# retries) of a 10s timeout, so the Redis lock must outlive ~65s of work; waiting for
+# it is bounded so a stuck holder can't pin a webhook thread forever.
+USER_LOCK_TIMEOUT_SECONDS = 120
+USER_LOCK_WAIT_SECONDS = 30
+
+def _acquire_user_lock(user_id):
+    """Return the acquired per-user lock, or None if it couldn't be taken in time."""
+    if _redis is not None:
+        lock = _redis.lock(f"lock:{user_id}", timeout=USER_LOCK_TIMEOUT_SECONDS)
+        return lock if lock.acquire(blocking_timeout=USER_LOCK_WAIT_SECONDS) else None
+    lock = _USER_LOCKS[hash(user_id) & 63]
+    lock.acquire()
+    return lock
+
+def _release_user_lock(user_id, lock):
+    try:
+        lock.release()
+    except Exception as e:
+        # the Redis lock expired while the handler ran; the message was still handled
+        app.logger.warning("Session lock for %s was lost before release: %s", user_id, e)
+
+def _dedup_key(msg_id):
+    # Store the 64-bit str hash rather than the ~60 char wamid: the hash is already
+    # cached on the str object, and a small int is far cheaper to keep in the LRU.
+    # (The wamid suffix is base64 padding/structure, so it can't be used directly.)
+    return hash(msg_id)
+
+def mark_message_processed(msg_id):
+    """Record msg_id in the dedup LRU. Returns False if it was already processed."""
+    if _redis is not None:
+        # SET NX is atomic, so only one worker ever wins a given message id
+        return bool(_redis.set(f"dedup:{msg_id}", "1", nx=True, ex=DEDUP_TTL_SECONDS))
+    key = _dedup_key(msg_id)
+    with _dedup_lock:
+        if key in processed_msg_ids:
+            processed_msg_ids.move_to_end(key)
+            return False
+        processed_msg_ids[key] = None
+        if len(processed_msg_ids) > MAX_PROCESSED_IDS:
+            processed_msg_ids.popitem(last=False)
+        return True
+
+def forget_message(msg_id):
+    """Drop msg_id from the dedup record so a redelivery of it is processed again."""
+    if _redis is not None:
+        _redis.delete(f"dedup:{msg_id}")
+        return
+    with _dedup_lock:
+        processed_msg_ids.pop(_dedup_key(msg_id), None)
+
+def mark_completed(user_id):
+    if _redis is not None:
+        _redis.set(f"cooled:{user_id}", "1", ex=COMPLETION_COOLDOWN_SECONDS)
+        return
+    with _cooldown_lock:
+        _completed_cooldown[user_id] = time.time()
+        _completed_cooldown.move_to_end(user_id)
+        if len(_completed_cooldown) > MAX_COOLDOWN_ENTRIES:
+            _completed_cooldown.popitem(last=False)
+
+def in_completion_cooldown(user_id):
+    if _redis is not None:
+        return bool(_redis.exists(f"cooled:{user_id}"))
+    with _cooldown_lock:
+        ts = _completed_cooldown.get(user_id)
+        if ts is None:
+            return False
+        if time.time() - ts < COMPLETION_COOLDOWN_SECONDS:
+            return True
+        _completed_cooldown.pop(user_id, None)
+        return False
+
+def _process_payload(data):
+    for entry in data.get("entry") or ():
+        for change in entry.get("changes") or ():
+            value = change.get("value")
+            messages = value.get("messages") if value else None
             if not messages:
                 continue
             msg = messages[0]
             msg_id = msg.get("id") or str(msg.get("timestamp")) or None
-            if msg_id:
-                if msg_id in processed_msg_ids:
-                    app.logger.debug("Duplicate msg %s ignored", msg_id)
-                    continue
-                processed_msg_ids.add(msg_id)
-                if len(processed_msg_ids) > 5000:
-                    processed_msg_ids.pop()
+            if msg_id and not mark_message_processed(msg_id):
+                app.logger.debug("Duplicate msg %s ignored", msg_id)
+                continue
 
             user_id = msg.get("from")
-            text_body = msg.get("text",{}).get("body","").strip()
-            button_id = msg.get("interactive",{}).get("button_reply",{}).get("id","")
-            incoming = (button_id or text_body or "").strip()
+            # a message carries either a button reply or a text body; only look up the one present
+            interactive = msg.get("interactive")
+            reply = interactive.get("button_reply") if interactive else None
+            incoming = reply.get("id") if reply else None
+            if not incoming:
+                text = msg.get("text")
+                incoming = text.get("body") if text else None
+            incoming = (incoming or "").strip()
 
             if not incoming:
                 continue
 
-            # start session
-            if user_id not in user_states:
-                user_states[user_id] = {"step": -1, "answers": {}, "questions": [], "started_at": time.time(), "last_active": time.time()}
-                # <-- UPDATED GREETING MESSAGE START -->
-                greeting = (
-                    "Hi 👋 I’m Orion from Kalagato.\n"
-                    "We’re interested in acquiring quality apps like yours.\n"
-                    "Would you be open to selling your app if the valuation looks right?"
-                )
-                send_whatsapp_buttons(user_id, greeting, ["Yes","No"])
-                # <-- UPDATED GREETING MESSAGE END -->
+            lock = _acquire_user_lock(user_id)
+            if lock is None:
+                # leave it to Meta's redelivery instead of losing the message
+                app.logger.error("Timed out waiting for session lock of %s; msg %s left for retry", user_id, msg_id)
+                if msg_id:
+                    forget_message(msg_id)
                 continue
+            try:
+                _handle_message(user_id, incoming)
+            finally:
+                _release_user_lock(user_id, lock)
 
-            state = user_states[user_id]
-            if time.time() - state.get("last_active",0) > SESSION_TIMEOUT_SECONDS:
-                user_states.pop(user_id, None)
-                # re-greet with Orion message
-                greeting = (
-                    "Hi 👋 I’m Orion from Kalagato.\n"
-                    "We’re interested in acquiring quality apps like yours.\n"
-                    "Would you be open to selling your app if the valuation looks right?"
-                )
-                send_whatsapp_buttons(user_id, greeting, ["Yes","No"])
-                continue
-            state["last_active"] = time.time()
-
-            # greeting
-            if state["step"] == -1:
-                low = incoming.lower()
-                if low in ("no","no_reply"):
-                    send_whatsapp_text(user_id, "Thanks! If you have any queries contact aman@kalagato.co")
-                    user_states.pop(user_id, None)
-                    continue
-                if low in ("yes","yes_reply"):
-                    state["step"] = 0
-                    send_whatsapp_text(user_id, "What is your name?")
-                    continue
-                send_whatsapp_buttons(user_id, "Please select Yes or No.", ["Yes","No"])
-                continue
+def _handle_message(user_id, incoming):
+    state = load_state(user_id)
 
-            # step 0: name entered
-            if state["step"] == 0:
-                state["answers"]["name"] = incoming
-                send_whatsapp_buttons(user_id, "Is your app listed on Play Store, App Store, or Both?", ["Play Store","App Store","Both"])
-                state["step"] = -2
-                continue
+    # start session
+    if state is None:
+        if in_completion_cooldown(user_id):
+            app.logger.debug("Ignoring message from %s during completion cooldown", user_id)
+            return
+        save_state(user_id, UserState())
+        send_whatsapp_buttons(user_id, GREETING_TEXT, ["Yes","No"])
+        return
 
-            # listing selection
-            if state["step"] == -2:
-                li = incoming.lower()
-                listing = ""
-                if li in ("play_store","play store","play"):
-                    listing = "play_store"
-                elif li in ("app_store","app store","app"):
-                    listing = "app_store"
-                elif li in ("both","both_reply"):
-                    listing = "both"
-                else:
-                    if "play" in li and "app" not in li:
-                        listing = "play_store"
-                    elif "app" in li and "play" not in li:
-                        listing = "app_store"
-                    elif "both" in li:
-                        listing = "both"
-                if not listing:
-                    send_whatsapp_buttons(user_id, "Please choose one: Play Store, App Store, or Both.", ["Play Store","App Store","Both"])
-                    continue
-                state["answers"]["listing"] = listing
-                questions = []
-                if listing == "app_store":
-                    questions.append({"key":"app_store_link","text":"Please provide the App Store link (https://...)", "type":"link_appstore"})
-                elif listing == "play_store":
-                    questions.append({"key":"play_store_link","text":"Please provide the Play Store link (https://...)", "type":"link_playstore"})
-                else:
-                    questions.append({"key":"app_store_link","text":"Please provide the App Store link (https://...)", "type":"link_appstore"})
-                    questions.append({"key":"play_store_link","text":"Please provide the Play Store link (https://...)", "type":"link_playstore"})
-                for q in OTHER_QUESTIONS:
-                    questions.append(q.copy())
-                state["questions"] = questions
-                state["step"] = 1
-                send_whatsapp_text(user_id, state["questions"][0]["text"])
-                continue
+    if time.time() - state.last_active > SESSION_TIMEOUT_SECONDS:
+        # start over with a fresh session and re-greet with Orion message
+        save_state(user_id, UserState())
+        send_whatsapp_buttons(user_id, GREETING_TEXT, ["Yes","No"])
+        return
+    state.last_active = time.time()
 
-            # ignore stray yes/no midflow
-            if state["step"] >= 1 and incoming.lower() in ("yes","no","yes_reply","no_reply"):
-                app.logger.debug("Ignored stray yes/no from %s mid-flow", user_id)
-                continue
+    if _advance_flow(user_id, state, incoming):
+        save_state(user_id, state)
+    else:
+        drop_state(user_id)
 
-            # normal flow
-            q_index = state["step"] - 1
-            if q_index < 0 or q_index >= len(state.get("questions", [])):
-                send_whatsapp_text(user_id, "Unexpected state. Please say Hi to restart.")
-                user_states.pop(user_id, None)
-                continue
+# Step handlers: each applies one inbound message and returns False once the
+# session is over.
+def _on_greeting_reply(user_id, state, incoming):
+    low = incoming.lower()
+    if low in ("no","no_reply"):
+        send_whatsapp_text(user_id, "Thanks! If you have any queries contact aman@kalagato.co")
+        return False
+    if low in ("yes","yes_reply"):
+        state.step = 0
+        send_whatsapp_text(user_id, "What is your name?")
+        return True
+    send_whatsapp_buttons(user_id, "Please select Yes or No.", ["Yes","No"])
+    return True
 
-            q = state["questions"][q_index]
-            key = q["key"]
-            val = incoming
-
-            valid = True
-            if q["type"] == "number":
-                if not is_number(val):
-                    valid = False
-            elif q["type"] == "email":
-                if not is_valid_email(val):
-                    valid = False
-            elif q["type"] == "link_appstore":
-                if not is_valid_url(val, "app_store"):
-                    valid = False
-            elif q["type"] == "link_playstore":
-                if not is_valid_url(val, "play_store"):
-                    valid = False
-            elif q["type"] == "revenue":
-                if not val:
-                    valid = False
-
-            if not valid:
-                if q["type"] == "number":
-                    send_whatsapp_text(user_id, "❌ Please enter a number (digits only).")
-                elif q["type"] == "email":
-                    send_whatsapp_text(user_id, "❌ Invalid email. Please provide a valid email address.")
-                elif q["type"] in ("link_appstore","link_playstore"):
-                    send_whatsapp_text(user_id, "❌ Please send a valid URL starting with http:// or https:// and the correct store domain.")
-                else:
-                    send_whatsapp_text(user_id, f"❌ Invalid input. {q['text']}")
-                send_whatsapp_text(user_id, q["text"])
-                continue
+def _on_name(user_id, state, incoming):
+    state.answers["name"] = incoming
+    send_whatsapp_buttons(user_id, "Is your app listed on Play Store, App Store, or Both?", ["Play Store","App Store","Both"])
+    state.step = -2
+    return True
 
-            # save answer
-            if q["type"] == "revenue":
-                raw = val
-                norm = []
-                parts = [p.strip().lower() for p in raw.replace(";",",").split(",") if p.strip()]
-                for p in parts:
-                    if p in ("1","iap","in-app","in app"):
-                        norm.append("iap")
-                    elif p in ("2","subscription","sub"):
-                        norm.append("subscription")
-                    elif p in ("3","ad","ads"):
-                        norm.append("ad")
-                    elif "ad" in p:
-                        norm.append("ad")
-                    elif "sub" in p:
-                        norm.append("subscription")
-                    elif "iap" in p:
-                        norm.append("iap")
-                seen = set(); final = []
-                for it in norm:
-                    if it not in seen:
-                        final.append(it); seen.add(it)
-                state["answers"]["revenue_type_raw"] = raw
-                state["answers"]["revenue_type_normalized"] = ", ".join(final)
-            else:
-                state["answers"][key] = val
-
-            # advance
-            state["step"] = state["step"] + 1
-            next_idx = state["step"] - 1
-            if next_idx < len(state.get("questions", [])):
-                send_whatsapp_text(user_id, state["questions"][next_idx]["text"])
-                if state["questions"][next_idx]["key"] == "revenue_type":
-                    send_whatsapp_buttons(user_id, "Tap a button for single option or reply with numbers/names for multiple (e.g. 1,3 or Ad,IAP).", ["IAP","Subscription","Ad"])
-                continue
+# exact answers (button ids, button titles, short names) -> listing
+_LISTING_CHOICES = {
+    "play_store": "play_store", "play store": "play_store", "play": "play_store",
+    "app_store": "app_store", "app store": "app_store", "app": "app_store",
+    "both": "both", "both_reply": "both",
+}
 
-            # finished collecting
-            answers = state["answers"]
-            answers["revenue_type_normalized"] = answers.get("revenue_type_normalized","")
-            profit_numeric = parse_number(answers.get("annual_profit", None)) or 0.0
-            normalized_rt = normalize_revenue_type(answers.get("revenue_type_normalized") or answers.get("revenue_type_raw") or "")
+def _on_listing(user_id, state, incoming):
+    li = incoming.lower()
+    listing = _LISTING_CHOICES.get(li, "")
+    if not listing:
+        # loose match for free text like "on the play store"
+        if "play" in li and "app" not in li:
+            listing = "play_store"
+        elif "app" in li and "play" not in li:
+            listing = "app_store"
+        elif "both" in li:
+            listing = "both"
+    if not listing:
+        send_whatsapp_buttons(user_id, "Please choose one: Play Store, App Store, or Both.", ["Play Store","App Store","Both"])
+        return True
+    state.answers["listing"] = listing
+    state.questions = QUESTIONS_BY_LISTING[listing]
+    state.step = 1
+    send_whatsapp_text(user_id, state.questions[0].text)
+    return True
 
-            vmin, vmax, mid = compute_valuation(profit_numeric, normalized_rt)
-            if vmin == vmax:
-                valuation_text = f"${vmin:,.2f}"
-            else:
-                valuation_text = f"${vmin:,.2f} to ${vmax:,.2f}"
+_LINK_ERROR = "❌ Please send a valid URL starting with http:// or https:// and the correct store domain."
+
+# question type -> (validator, error sent before repeating the question)
+_VALIDATORS = {
+    "number": (is_number, "❌ Please enter a number (digits only)."),
+    "email": (is_valid_email, "❌ Invalid email. Please provide a valid email address."),
+    "link_appstore": (lambda v: is_valid_url(v, "app_store"), _LINK_ERROR),
+    "link_playstore": (lambda v: is_valid_url(v, "play_store"), _LINK_ERROR),
+    "revenue": (bool, "❌ Invalid input."),
+}
 
-            # Save midpoint numeric into sheet
-            valuation_mid = float(mid)
+def _on_question_answer(user_id, state, incoming):
+    # ignore stray yes/no midflow
+    if incoming.lower() in ("yes","no","yes_reply","no_reply"):
+        app.logger.debug("Ignored stray yes/no from %s mid-flow", user_id)
+        return True
 
-            saved = save_to_sheet(user_id, answers, valuation_mid)
+    q_index = state.step - 1
+    if q_index < 0 or q_index >= len(state.questions):
+        send_whatsapp_text(user_id, "Unexpected state. Please say Hi to restart.")
+        return False
 
-            # call supabase function (existing) - includes _valuation_text and cc emails
-            ok, resp = call_supabase_send_email_for_existing_function(answers, valuation_text, valuation_mid)
+    q = state.questions[q_index]
+    key = q.key
+    val = incoming
 
-            if ok:
-                send_whatsapp_text(user_id, f"✅ Thank you {answers.get('name','')}.We've sent your valuation to your email. The final valuation may vary slightly based on the data during processing")
-            else:
-                send_whatsapp_text(user_id, "✅ Saved your data, but we couldn't send the email automatically. Please visit www.kalagato.ai to get valuation.")
-                app.logger.warning("Supabase function failed: %s", resp)
+    check = _VALIDATORS.get(q.type)
+    if check is not None and not check[0](val):
+        # one message instead of error + re-prompt
+        send_whatsapp_text(user_id, f"{check[1]}\n\n{q.text}")
+        return True
 
-            # cleanup
-            user_states.pop(user_id, None)
+    # save answer
+    if q.type == "revenue":
+        state.answers["revenue_type_raw"] = val
+        state.answers["revenue_type_normalized"] = ", ".join(parse_multi_choice(val))
+    else:
+        state.answers[key] = val
+
+    # advance
+    state.step = state.step + 1
+    next_idx = state.step - 1
+    if next_idx < len(state.questions):
+        send_whatsapp_text(user_id, state.questions[next_idx].text)
+        if state.questions[next_idx].key == "revenue_type":
+            send_whatsapp_buttons(user_id, "Tap a button for single option or reply with numbers/names for multiple (e.g. 1,3 or Ad,IAP).", ["IAP","Subscription","Ad"])
+        return True
+
+    # finished collecting: the rest doesn't touch session state, so run it off the user lock
+    mark_completed(user_id)
+    submit_finalize(user_id, dict(state.answers))
+    return False
+
+STEP_HANDLERS = {
+    -1: _on_greeting_reply,
+    0: _on_name,
+    -2: _on_listing,
+}
+
+def _advance_flow(user_id, state, incoming):
+    """Apply one message to the conversation. Returns False once the session is over."""
+    # steps 1..n are the per-listing questions
+    handler = STEP_HANDLERS.get(state.step, _on_question_answer)
+    return handler(user_id, state, incoming)
+
+# With Redis configured, finished conversations are queued on a Redis list so a job
+# isn't lost if this process is recycled before it runs; any worker's consumer
+# thread may pick it up. Without Redis they go straight to WEBHOOK_POOL.
+VALUATION_JOBS_KEY = "valuation_jobs"
+_job_worker = None
+_job_worker_lock = threading.Lock()
+
+def submit_finalize(user_id, answers):
+    if _redis is None:
+        WEBHOOK_POOL.submit(_finalize, user_id, answers).add_done_callback(_log_worker_error)
+        return
+    _redis.rpush(VALUATION_JOBS_KEY, orjson.dumps({"user_id": user_id, "answers": answers}))
+    _ensure_job_worker()
+
+def _valuation_job_worker():
+    while True:
+        try:
+            item = _redis.blpop(VALUATION_JOBS_KEY, timeout=5)
+        except Exception as e:
+            app.logger.error("Reading valuation jobs failed: %s", e)
+            time.sleep(1)
+            continue
+        if item is None:
+            continue
+        try:
+            job = orjson.loads(item[1])
+            user_id, answers = job["user_id"], job["answers"]
+        except Exception as e:
+            # a bad entry must not take the consumer thread down with it
+            app.logger.error("Skipping malformed valuation job %r: %s", item[1], e)
+            continue
+        try:
+            _finalize(user_id, answers)
+        except Exception as e:
+            app.logger.exception("Valuation job for %s failed: %s", user_id, e)
+
+def _ensure_job_worker():
+    global _job_worker
+    if _redis is None or _job_worker is not None:
+        return
+    with _job_worker_lock:
+        if _job_worker is None:
+            _job_worker = threading.Thread(target=_valuation_job_worker, name="valuation-jobs", daemon=True)
+            _job_worker.start()
+
+def _finalize(user_id, answers):
+    """Compute the valuation, record it and send the confirmation for a finished conversation."""
+    answers["revenue_type_normalized"] = answers.get("revenue_type_normalized","")
+    figures = parse_financials(answers)
+    profit_numeric = figures["annual_profit"] or 0.0
+    normalized_rt = primary_revenue_type(answers)
+
+    vmin, vmax, mid = compute_valuation(profit_numeric, normalized_rt)
+    if vmin == vmax:
+        valuation_text = f"${vmin:,.2f}"
+    else:
+        valuation_text = f"${vmin:,.2f} to ${vmax:,.2f}"
+
+    # Save midpoint numeric into sheet
+    valuation_mid = float(mid)
+
+    save_to_sheet(user_id, answers, valuation_mid)
+
+    if not SUPABASE_FUNCTION_URL:
+        # no email can go out, so don't promise one
+        send_whatsapp_text(user_id, EMAIL_FAILED_TEXT)
+    else:
+        # thank first: if the email then fails, its fallback message arrives after this one
+        send_whatsapp_text(user_id, THANK_YOU_TEMPLATE.format(name=answers.get("name","")))
+        # call supabase function (existing) off the request path - includes _valuation_text and cc emails
+        EMAIL_POOL.submit(send_valuation_email, user_id, answers, figures, normalized_rt, valuation_text, valuation_mid)
+
+@app.route("/webhook", methods=["GET","POST"])
+def webhook():
+    if request.method == "GET":
+        token = request.args.get("hub.verify_token")
+        if token and token == VERIFY_TOKEN:
+            return request.args.get("hub.challenge"), 200
+        return "Invalid verify token", 403
 
+    raw = request.get_data(cache=False)
+    if not raw:
+        return "No payload", 400
+    # most deliveries are status/read receipts with no inbound message: ack them
+    # without parsing
+    if b'"messages"' not in raw:
+        return "OK", 200
+    try:
+        data = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return "Bad JSON", 400
+    if not data or not isinstance(data, dict):
+        return "No payload", 400
+
+    # acknowledge right away so Meta doesn't retry; the actual work (WhatsApp,
+    # Sheets, Supabase) happens on the webhook pool
+    _ensure_job_worker()
+    WEBHOOK_POOL.submit(_process_payload, data).add_done_callback(_log_worker_error)
     return "OK", 200
 
 @app.route("/health", methods=["GET"])
@@ -548,9 +1035,6 @@ def health():
     return "OK", 200
 
 if __name__ == "__main__":
-    try:
-        try_init_gs()
-    except Exception as e:
-        app.logger.warning("Initial Google Sheets init failed (continuing): %s", e)
+    # Google Sheets is initialized lazily by the sheet writer on the first completed flow
     port = int(os.getenv("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
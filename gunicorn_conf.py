@@ -0,0 +1,19 @@
+# gunicorn_conf.py
+import os
+import multiprocessing
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+# Sessions and dedup live in each process unless REDIS_URL is set, so only run
+# several workers when that state is shared.
+if os.getenv("REDIS_URL", "").strip():
+    workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+else:
+    workers = 1
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+
+# import app.py once in the master (config, credentials parsing) and fork workers
+# from it; pools, sessions and the sheet writer only start after the fork
+preload_app = True
+keepalive = 30